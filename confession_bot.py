@@ -1,15 +1,25 @@
-import json
+import asyncio
+import hashlib
+import html
 import os
 import logging
-from functools import wraps
-from datetime import datetime
-from pytz import utc
+import mmap
+import re
+import time
+import weakref
+import ijson
+import orjson
+from functools import lru_cache, wraps
+from itertools import islice
 from dotenv import load_dotenv
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Chat, BotCommand
+from telegram.constants import ParseMode
 from telegram.ext import (
+    AIORateLimiter,
     Application,
     CommandHandler,
+    Defaults,
     MessageHandler,
     CallbackQueryHandler,
     ContextTypes,
@@ -33,7 +43,15 @@ try:
     ADMIN_GROUP_ID = int(os.getenv("ADMIN_GROUP_ID"))
 except Exception:
     ADMIN_GROUP_ID = -100
+# Webhooks deliver updates as soon as Telegram has them, while long polling keeps a
+# request parked and adds a round trip per batch. Railway only sets RAILWAY_PUBLIC_DOMAIN
+# once a public domain exists; Fly.io sets FLY_APP_NAME on every machine, so there the
+# webhook is only assumed when PORT is set explicitly for the app's HTTP service.
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+if not WEBHOOK_URL and os.getenv("RAILWAY_PUBLIC_DOMAIN"):
+    WEBHOOK_URL = f"https://{os.getenv('RAILWAY_PUBLIC_DOMAIN')}"
+elif not WEBHOOK_URL and os.getenv("FLY_APP_NAME") and os.getenv("PORT"):
+    WEBHOOK_URL = f"https://{os.getenv('FLY_APP_NAME')}.fly.dev"
 PORT = int(os.getenv("PORT", 8000))
 
 # --- PERSISTENCE FIX ---
@@ -41,34 +59,354 @@ PORT = int(os.getenv("PORT", 8000))
 # We default to /data, which MUST be mapped to a Railway Volume.
 DATA_PATH = os.getenv("DATA_PATH", "/data") 
 DATA_FILE = os.path.join(DATA_PATH, "confessions_store.json")
+WAL_FILE = DATA_FILE + ".log"
+COMMANDS_HASH_FILE = os.path.join(DATA_PATH, "bot_commands.hash")
 # -----------------------
 
 ADMIN_ALIAS = "Admin"
 MAX_BATCH_APPROVAL = 15
+_START_COMMENT_RE = re.compile(r"comment_(\d+)")
+_ALIAS_RE = re.compile(r"[\w ]{3,20}")  # letters/digits (any script), underscore and spaces
+MAX_CONFESSION_LENGTH = 3500  # UTF-16 code units; leaves room for the header within Telegram's 4096 limit
+WAL_COMPACT_BYTES = 1024 * 1024
+SNAPSHOT_STREAM_BYTES = 8 * 1024 * 1024  # larger snapshots are stream-parsed on load
+READ_BUFFER_BYTES = 64 * 1024
+COMMIT_BATCH_SIZE = 64
+COMMIT_WINDOW = 0.02  # seconds to wait for more events before syncing a batch
 
 # ===== Persistent Storage =====
-store = {"next_id": 1, "pending": {}, "posted": {}, "user_profiles": {}}
+# User-supplied text (confessions, comments, aliases) is HTML-escaped once when
+# it is stored, so every message can embed it as-is (HTML is the default parse mode).
+# The store lives in memory. On disk it is a JSON snapshot (DATA_FILE) plus an
+# append-only NDJSON log of mutation events (WAL_FILE) written since that
+# snapshot. Every change goes through commit(), which applies the event and
+# queues one line for the log; a single background task writes queued lines in
+# batches with one fsync per batch. load_store() replays the log over the snapshot.
+store = {"next_id": 1, "seq": 0, "text_format": "html", "pending": {}, "posted": {}, "user_profiles": {}}
+
+class WAL:
+    """Append-only NDJSON event log."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fh = None
+        self.torn_at = None  # byte offset of the first unreadable line found by replay()
+
+    def open(self):
+        self._fh = open(self.path, "ab", buffering=0)
+
+    def append(self, data: bytes):
+        # Unbuffered writes may be short; loop so a batch is never left half-written
+        view = memoryview(data)
+        while view:
+            view = view[self._fh.write(view):]
+
+    def sync(self):
+        os.fsync(self._fh.fileno())
+
+    def size(self) -> int:
+        return os.fstat(self._fh.fileno()).st_size
+
+    def truncate(self, size: int = 0):
+        self._fh.truncate(size)
+
+    def close(self):
+        self._fh.close()
+
+    def replay(self):
+        self.torn_at = None
+        if not os.path.exists(self.path):
+            return
+        # Up to WAL_COMPACT_BYTES of short lines; a larger buffer means far fewer read() calls
+        with open(self.path, "rb", buffering=READ_BUFFER_BYTES) as f:
+            offset = 0
+            for line in f:
+                try:
+                    event = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    # Normally a torn last line from a crash mid-append. Later events may
+                    # depend on the lost one, so replay stops here either way.
+                    skipped = 1 + sum(1 for _ in f)
+                    logger.warning(f"Ignoring {skipped} unreadable or trailing lines from byte {offset} of {self.path}.")
+                    self.torn_at = offset
+                    return
+                offset += len(line)
+                yield event
+
+    def cut_torn_tail(self):
+        """Moves everything from torn_at on into a side file so new appends never follow it."""
+        if self.torn_at is None:
+            return
+        side_file = f"{self.path}.corrupt-{int(time.time())}"
+        with open(self.path, "r+b") as f:
+            f.seek(self.torn_at)
+            with open(side_file, "wb") as side:
+                side.write(f.read())
+                os.fsync(side.fileno())
+            f.truncate(self.torn_at)
+            os.fsync(f.fileno())
+        logger.warning(f"Moved the unreadable tail of {self.path} to {side_file}.")
+        self.torn_at = None
+
+wal = WAL(WAL_FILE)
+
+# --- Event handlers: each one replays a single mutation onto the store ---
+def _apply_set_alias(event):
+    store["user_profiles"][event["user_id"]] = event["alias"]
+
+def _apply_add_pending(event):
+    store["pending"][event["pending_id"]] = event["pending"]
+    store["next_id"] = event["pending"]["id"] + 1
+
+def _apply_approve(event):
+    pending = store["pending"].pop(event["pending_id"])
+    store["posted"][pending["id"]] = {"text": pending["text"], "user_alias": pending["user_alias"], "replies": [], "channel_message_id": None}
+
+def _apply_set_channel_message(event):
+    store["posted"][event["conf_id"]]["channel_message_id"] = event["message_id"]
+
+def _apply_reject(event):
+    store["pending"].pop(event["pending_id"], None)
+
+def _apply_add_reply(event):
+    store["posted"][event["conf_id"]].setdefault("replies", []).append(event["reply"])
+
+_EVENT_HANDLERS = {
+    "set_alias": _apply_set_alias,
+    "add_pending": _apply_add_pending,
+    "approve": _apply_approve,
+    "set_channel_message": _apply_set_channel_message,
+    "reject": _apply_reject,
+    "add_reply": _apply_add_reply,
+}
+
+def _escape_legacy_text(data):
+    # Snapshots written before text was escaped at storage time hold raw text.
+    for user_id, alias in data.get("user_profiles", {}).items():
+        data["user_profiles"][user_id] = html.escape(alias)
+    for conf in list(data.get("pending", {}).values()) + list(data.get("posted", {}).values()):
+        conf["text"] = html.escape(conf["text"])
+        conf["user_alias"] = html.escape(conf["user_alias"])
+        for reply in conf.get("replies", []):
+            reply["alias"] = html.escape(reply["alias"])
+            reply["text"] = html.escape(reply["text"])
+    data["text_format"] = "html"
+
+def _read_snapshot_mapped(path: str) -> dict:
+    """Parses the snapshot in one orjson call straight from a read-only memory map."""
+    with open(path, "rb") as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # mmap refuses empty files
+            data = orjson.loads(f.read())
+        else:
+            with mm, memoryview(mm) as view:
+                data = orjson.loads(view)
+    # JSON object keys are always strings; ids are ints in memory.
+    for key in ("user_profiles", "posted"):
+        data[key] = {int(k): v for k, v in data.get(key, {}).items()}
+    return data
+
+def _read_snapshot_streamed(path: str) -> dict:
+    """Stream-parses the snapshot, building each confession/profile straight into its section."""
+    data = {}
+    with open(path, "rb") as f:
+        # Top-level scalars (next_id, seq, ...) are the only events without a dotted prefix.
+        for prefix, event, value in ijson.parse(f, buf_size=READ_BUFFER_BYTES, use_float=True):
+            if "." not in prefix and event in ("number", "string"):
+                data[prefix] = value
+        for key in ("user_profiles", "pending", "posted"):
+            f.seek(0)
+            items = ijson.kvitems(f, key, buf_size=READ_BUFFER_BYTES, use_float=True)
+            # JSON object keys are always strings; ids are ints in memory.
+            data[key] = dict(items) if key == "pending" else {int(k): v for k, v in items}
+    return data
+
+def _read_snapshot(path: str) -> dict:
+    # orjson on a memory map is fastest; ijson keeps peak memory flat for big stores.
+    if os.path.getsize(path) < SNAPSHOT_STREAM_BYTES:
+        return _read_snapshot_mapped(path)
+    return _read_snapshot_streamed(path)
 
 def load_store():
     global store
     if os.path.exists(DATA_FILE):
         try:
-            with open(DATA_FILE, "r", encoding="utf-8") as f:
-                loaded_data = json.load(f)
-                store.update(loaded_data)
+            loaded_data = _read_snapshot(DATA_FILE)
+            if loaded_data.get("text_format") != "html":
+                _escape_legacy_text(loaded_data)
+            store.update(loaded_data)
             logger.info(f"Successfully loaded data store from {DATA_FILE}.")
-        except json.JSONDecodeError:
-            logger.warning(f"Failed to load data store from {DATA_FILE}. Starting fresh.")
-
-def save_store():
-    # Ensure the directory exists before saving
+        except (orjson.JSONDecodeError, ijson.JSONError):
+            # The log only holds changes on top of this snapshot, so it cannot be replayed
+            # onto an empty store. Keep both files for recovery; compact() would overwrite them.
+            suffix = f".corrupt-{int(time.time())}"
+            for path in (DATA_FILE, WAL_FILE):
+                if os.path.exists(path):
+                    os.replace(path, path + suffix)
+            logger.error(f"Failed to load data store from {DATA_FILE}; moved it and its log aside with suffix {suffix}. Starting fresh.")
+
+    # Events up to store["seq"] are already in the snapshot (e.g. a crash between
+    # writing the snapshot and truncating the log), so they are skipped.
+    replayed = 0
+    for event in wal.replay():
+        if event["seq"] <= store["seq"]:
+            continue
+        _EVENT_HANDLERS[event["op"]](event)
+        store["seq"] = event["seq"]
+        replayed += 1
+    if replayed:
+        logger.info(f"Replayed {replayed} events from {WAL_FILE}.")
+
+    wal.cut_torn_tail()
     os.makedirs(DATA_PATH, exist_ok=True)
+    wal.open()
+
+# Disk writes below run in a worker thread (asyncio.to_thread) so an fsync never
+# stalls the event loop; the store itself is only serialized on the loop thread.
+def _write_events(data: bytes):
+    wal.append(data)
+    wal.sync()
+
+def _write_snapshot(data: bytes):
+    # DATA_PATH is created once by load_store() at startup.
+    tmp_file = DATA_FILE + ".tmp"
+    # The log is only truncated once the new snapshot (and its directory
+    # entry) is durable, so a crash at any point leaves a readable store.
+    # Unbuffered: the whole encoded snapshot goes down in one write() call.
+    fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(tmp_file, DATA_FILE)
+    dir_fd = os.open(DATA_PATH, os.O_RDONLY)
     try:
-        with open(DATA_FILE, "w", encoding="utf-8") as f:
-            json.dump(store, f, ensure_ascii=False, indent=2)
-        logger.debug(f"Successfully saved data store to {DATA_FILE}.")
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+    wal.truncate()
+
+async def _snapshot():
+    await asyncio.to_thread(_write_snapshot, orjson.dumps(store, option=orjson.OPT_NON_STR_KEYS))
+    logger.info(f"Compacted data store into {DATA_FILE}.")
+
+async def compact():
+    """Atomically replaces the snapshot with the current store and empties the log."""
+    try:
+        await _snapshot()
     except Exception as e:
-        logger.error(f"Failed to save data store: {e}")
+        logger.error(f"Failed to compact data store: {e}")
+
+_commit_queue = None
+_commit_task = None
+
+async def commit(event: dict):
+    """Applies a mutation event to the store and waits until it is on disk."""
+    if _commit_task is None or _commit_task.done():
+        raise RuntimeError("The commit loop is not running; refusing to change the store.")
+    store["seq"] += 1
+    event["seq"] = store["seq"]
+    _EVENT_HANDLERS[event["op"]](event)
+    done = asyncio.get_running_loop().create_future()
+    _commit_queue.put_nowait((orjson.dumps(event, option=orjson.OPT_APPEND_NEWLINE), done))
+    await done
+
+async def _write_batch(batch: list, needs_snapshot: bool) -> bool:
+    """Makes a batch durable and returns whether the log still needs a snapshot; raises if neither worked."""
+    if not needs_snapshot:
+        good_size = wal.size()
+        try:
+            await asyncio.to_thread(_write_events, b"".join(line for line, _ in batch))
+            logger.debug(f"Committed {len(batch)} events to {WAL_FILE}.")
+            return False
+        except Exception as e:
+            logger.error(f"Failed to append {len(batch)} events to {WAL_FILE}: {e}")
+            try:
+                wal.truncate(good_size)
+            except OSError as te:
+                logger.error(f"Failed to cut {WAL_FILE} back to {good_size} bytes: {te}")
+    # The store in memory already holds this batch, so a snapshot makes it durable
+    # and leaves an empty log to append to.
+    await _snapshot()
+    return False
+
+async def _commit_loop():
+    # Group commit: whatever arrives within COMMIT_WINDOW of the first queued
+    # event is written with a single write() and a single fsync().
+    loop = asyncio.get_running_loop()
+    stopping = False
+    # Set after a failed write: nothing more is appended until a snapshot has
+    # captured the store and reset the log, so no event ever follows a torn line.
+    needs_snapshot = False
+    while not stopping:
+        item = await _commit_queue.get()
+        batch = []
+        # Whatever goes wrong below fails this batch instead of the loop, and every
+        # future gets a result or an exception so no handler waits forever.
+        error = RuntimeError("The commit loop stopped before the batch was written.")
+        try:
+            deadline = loop.time() + COMMIT_WINDOW
+            while True:
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+                if len(batch) >= COMMIT_BATCH_SIZE:
+                    break
+                try:
+                    item = await asyncio.wait_for(_commit_queue.get(), max(deadline - loop.time(), 0))
+                except asyncio.TimeoutError:
+                    break
+            if batch:
+                needs_snapshot = await _write_batch(batch, needs_snapshot)
+            error = None
+        except Exception as e:
+            logger.error(f"Failed to commit {len(batch)} events: {e}")
+            error = e
+            needs_snapshot = True
+        finally:
+            # Only acknowledge events that are on disk; otherwise commit() raises.
+            for _, done in batch:
+                if done.done():
+                    continue
+                if error:
+                    done.set_exception(error)
+                else:
+                    done.set_result(None)
+
+        if not needs_snapshot:
+            try:
+                if wal.size() > WAL_COMPACT_BYTES:
+                    await compact()
+            except OSError as e:
+                logger.error(f"Failed to check the size of {WAL_FILE}: {e}")
+
+def _on_commit_loop_done(task: asyncio.Task):
+    if not task.cancelled() and task.exception():
+        logger.error(f"Commit loop crashed: {task.exception()}")
+    # Fail anything queued after the last batch so its commit() raises instead of hanging.
+    while not _commit_queue.empty():
+        item = _commit_queue.get_nowait()
+        if item and not item[1].done():
+            item[1].set_exception(RuntimeError("The commit loop stopped before the event was written."))
+
+def start_commit_loop():
+    global _commit_queue, _commit_task
+    _commit_queue = asyncio.Queue()
+    _commit_task = asyncio.create_task(_commit_loop())
+    _commit_task.add_done_callback(_on_commit_loop_done)
+
+async def stop_commit_loop():
+    """Flushes queued events, then writes a final snapshot."""
+    _commit_queue.put_nowait(None)
+    await _commit_task
+    await compact()
+    wal.close()
 
 # ===== Access Control (is_admin_chat decorator) =====
 def is_admin_chat(func):
@@ -81,15 +419,46 @@ def is_admin_chat(func):
         return await func(update, context)
     return wrapper
 
+# ===== Per-chat Serialization =====
+# Updates are processed concurrently (see main()); this keeps the updates of a
+# single chat in order while other chats proceed. Idle locks are dropped.
+_chat_locks = weakref.WeakValueDictionary()
+
+def serialized_per_chat(func):
+    @wraps(func)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        chat_id = update.effective_chat.id
+        lock = _chat_locks.get(chat_id)
+        if lock is None:
+            lock = _chat_locks[chat_id] = asyncio.Lock()
+        async with lock:
+            return await func(update, context)
+    return wrapper
+
 # ===== Helpers =====
 def get_user_alias(user_id: int) -> str:
-    return store["user_profiles"].get(str(user_id), "Anonymous")
+    return store["user_profiles"].get(user_id, "Anonymous")
+
+def excerpt(text: str, length: int = 50) -> str:
+    """Shortens stored (escaped) text without cutting an HTML entity in half."""
+    cut = text[:length]
+    amp = cut.rfind("&")
+    if amp != -1 and ";" not in cut[amp:]:
+        cut = cut[:amp]
+    return cut
+
+# Posted confessions never change, so the rendered text of recently viewed ones is kept.
+@lru_cache(maxsize=1024)
+def _render_confession(conf_id: int) -> str:
+    conf = store["posted"][conf_id]
+    return f"<b>Confession #{conf_id}</b> (by {conf.get('user_alias','Anonymous')})\n\n{conf['text']}"
 
 def get_confession_text(conf_id: int) -> str:
-    conf = store["posted"].get(str(conf_id))
-    if not conf: return "⚠️ Confession not found."
-    return f"*Confession #{conf_id}* (by {conf.get('user_alias','Anonymous')})\n\n{conf['text']}"
+    if conf_id not in store["posted"]: return "⚠️ Confession not found."
+    return _render_confession(conf_id)
 
+# Telegram objects are immutable in PTB, so one markup per id can be reused for every send.
+@lru_cache(maxsize=4096)
 def get_confession_markup(conf_id: int) -> InlineKeyboardMarkup:
     keyboard = [
         [
@@ -99,169 +468,199 @@ def get_confession_markup(conf_id: int) -> InlineKeyboardMarkup:
     ]
     return InlineKeyboardMarkup(keyboard)
 
+@lru_cache(maxsize=1024)
+def get_moderation_markup(pending_id: str) -> InlineKeyboardMarkup:
+    keyboard = [[
+        InlineKeyboardButton("✅ Approve", callback_data=f"approve|{pending_id}"),
+        InlineKeyboardButton("❌ Reject", callback_data=f"reject|{pending_id}")
+    ]]
+    return InlineKeyboardMarkup(keyboard)
+
+@lru_cache(maxsize=2048)
+def get_comment_link_markup(bot_username: str, conf_id: int) -> InlineKeyboardMarkup:
+    # Deep link back into the bot for the channel post; the username comes from
+    # context.bot.username, which Bot.initialize() caches from get_me().
+    keyboard = [[InlineKeyboardButton("💬 Add/View Comments", url=f"https://t.me/{bot_username}?start=comment_{conf_id}")]]
+    return InlineKeyboardMarkup(keyboard)
+
 async def send_confession_options(update: Update, context: ContextTypes.DEFAULT_TYPE, conf_id: int):
     text = get_confession_text(conf_id)
     markup = get_confession_markup(conf_id)
     if update.callback_query and update.callback_query.message:
-        await update.callback_query.edit_message_text(text, parse_mode="Markdown", reply_markup=markup)
+        await update.callback_query.edit_message_text(text, reply_markup=markup)
     elif update.message:
-        await update.message.reply_text(text, parse_mode="Markdown", reply_markup=markup)
+        await update.message.reply_text(text, reply_markup=markup)
 
 async def submit_pending_confession(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+    # Telegram measures text in UTF-16 code units, so an emoji counts twice
+    if len(text.encode("utf-16-le")) // 2 > MAX_CONFESSION_LENGTH:
+        await update.message.reply_text(f"⚠️ Your confession is too long (max {MAX_CONFESSION_LENGTH} characters).")
+        return
+    text = html.escape(text)
     conf_id = store['next_id']
     pending_id = f"p{conf_id}"
     user_id = update.effective_user.id
     user_alias = get_user_alias(user_id)
-    store["next_id"] += 1
-    store["pending"][pending_id] = {"id": conf_id, "text": text, "from_user": user_id, "user_alias": user_alias}
-    save_store()
+    pending = {"id": conf_id, "text": text, "from_user": user_id, "user_alias": user_alias}
+    await commit({"op": "add_pending", "pending_id": pending_id, "pending": pending})
 
-    keyboard = [[
-        InlineKeyboardButton("✅ Approve", callback_data=f"approve|{pending_id}"),
-        InlineKeyboardButton("❌ Reject", callback_data=f"reject|{pending_id}")
-    ]]
     try:
         await context.bot.send_message(
             chat_id=ADMIN_GROUP_ID,
-            text=f"🆕 *Pending Confession #{conf_id}* (ID: {pending_id} | Alias: {user_alias})\n\n{text}",
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            text=f"🆕 <b>Pending Confession #{conf_id}</b> (ID: {pending_id} | Alias: {user_alias})\n\n{text}",
+            reply_markup=get_moderation_markup(pending_id)
         )
         await update.message.reply_text("✅ Your confession has been submitted for admin review.")
     except Exception as e:
         logger.error(f"Failed to submit confession: {e}")
-        await update.message.reply_text("⚠️ Failed to submit confession. Check `ADMIN_GROUP_ID`.")
+        await update.message.reply_text("⚠️ Failed to submit confession. Check <code>ADMIN_GROUP_ID</code>.")
 
 # ===== Handlers (Including simple state handling for comments) =====
+@serialized_per_chat
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.type == Chat.PRIVATE:
         alias = get_user_alias(update.effective_user.id)
-        msg = f"👋 Welcome! Your current alias: *{alias}*\nSend a message here to confess anonymously or use /confess."
-        await update.message.reply_text(msg, parse_mode="Markdown")
+        msg = f"👋 Welcome! Your current alias: <b>{alias}</b>\nSend a message here to confess anonymously or use /confess."
+        await update.message.reply_text(msg)
     
-    # Simple Deeplink/Start Parameter handling (e.g., from channel button)
-    if context.args and context.args[0].startswith("comment_"):
-        try:
-            conf_id = int(context.args[0].split('_')[1])
-            await send_confession_options(update, context, conf_id)
-        except (IndexError, ValueError):
-            pass # Ignore bad start parameters
+    # Simple Deeplink/Start Parameter handling (e.g., from channel button); bad parameters are ignored
+    match = _START_COMMENT_RE.fullmatch(context.args[0]) if context.args else None
+    if match:
+        await send_confession_options(update, context, int(match.group(1)))
 
+@serialized_per_chat
 async def set_alias_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
-        await update.message.reply_text("Usage: /setalias <nickname>")
+        await update.message.reply_text("Usage: /setalias &lt;nickname&gt;")
         return
     alias = " ".join(context.args).strip()
-    store["user_profiles"][str(update.effective_user.id)] = alias
-    save_store()
-    await update.message.reply_text(f"✅ Alias set to *{alias}*", parse_mode="Markdown")
+    if not _ALIAS_RE.fullmatch(alias):
+        await update.message.reply_text("⚠️ Alias must be 3-20 characters: letters, digits, underscores or spaces.")
+        return
+    alias = html.escape(alias)
+    await commit({"op": "set_alias", "user_id": update.effective_user.id, "alias": alias})
+    await update.message.reply_text(f"✅ Alias set to <b>{alias}</b>")
 
+@serialized_per_chat
 async def confess_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("📝 Send your anonymous confession now.")
 
 # State machine for receiving the actual comment text after button click
+@serialized_per_chat
 async def handle_text_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text.strip()
     user_id = update.effective_user.id
 
-    # 1. Check if the user is in the 'awaiting_reply' state
-    user_data = context.user_data.get(user_id, {})
-    if user_data.get("state") == "awaiting_reply":
-        conf_id = user_data["conf_id"]
+    # 1. Check if the user is in the 'awaiting_reply' state (popping clears it either way)
+    if context.user_data.pop("state", None) == "awaiting_reply":
+        conf_id = context.user_data.pop("conf_id")
         
         # Simple placeholder for comment storage
-        conf = store["posted"].get(str(conf_id))
+        conf = store["posted"].get(conf_id)
         if conf:
-            conf.setdefault("replies", []).append({
+            await commit({"op": "add_reply", "conf_id": conf_id, "reply": {
                 "alias": get_user_alias(user_id),
-                "text": text,
-                "timestamp": datetime.now(utc).isoformat()
-            })
-            save_store()
+                "text": html.escape(text),
+                "ts": time.time_ns()
+            }})
             await update.message.reply_text(f"✅ Your comment has been saved for Confession #{conf_id}.")
-            
-            # Clear the state
-            context.user_data[user_id] = {}
             return
         
     # 2. If not in a special state, treat it as a new confession submission
     if not text: return
     await submit_pending_confession(update, context, text)
 
-async def handle_callbacks(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
+# --- Callback query handlers, one per callback_data action ---
+async def _cb_add_comment(query, context: ContextTypes.DEFAULT_TYPE, arg: str):
     await query.answer()
-    data = query.data.split("|")
-    user_id = update.effective_user.id
+    conf_id = int(arg)
+    # Set the user state to awaiting_reply
+    context.user_data["state"] = "awaiting_reply"
+    context.user_data["conf_id"] = conf_id
+    await query.edit_message_text(f"📝 Send your comment text now for Confession #{conf_id}.")
 
-    if data[0] == "add_comment":
-        conf_id = int(data[1])
-        # Set the user state to awaiting_reply
-        context.user_data[user_id] = {"state": "awaiting_reply", "conf_id": conf_id}
-        await query.edit_message_text(f"📝 Send your comment text now for Confession #{conf_id}.")
+async def _cb_browse_comments(query, context: ContextTypes.DEFAULT_TYPE, arg: str):
+    await query.answer()
+    conf_id = int(arg)
+    conf = store["posted"].get(conf_id)
+    if not conf or not conf.get("replies"):
+        await query.edit_message_text(f"Confession #{conf_id} has no comments yet.", reply_markup=get_confession_markup(conf_id))
         return
+    
+    comment_list = [f"<b>{r['alias']}</b>: {excerpt(r['text'])}..." for r in conf['replies']]
+    
+    reply_text = f"💬 <b>Comments for Confession #{conf_id}</b>\n\n" + "\n---\n".join(comment_list)
+    await query.edit_message_text(reply_text, reply_markup=get_confession_markup(conf_id))
 
-    if data[0] == "browse_comments":
-        conf_id = int(data[1])
-        conf = store["posted"].get(str(conf_id))
-        if not conf or not conf.get("replies"):
-            await query.edit_message_text(f"Confession #{conf_id} has no comments yet.", reply_markup=get_confession_markup(conf_id))
-            return
-        
-        comment_list = [f"*{r['alias']}*: {r['text'][:50]}..." for r in conf['replies']]
-        
-        reply_text = f"💬 *Comments for Confession #{conf_id}*\n\n" + "\n---\n".join(comment_list)
-        await query.edit_message_text(reply_text, parse_mode="Markdown", reply_markup=get_confession_markup(conf_id))
+async def _cb_approve(query, context: ContextTypes.DEFAULT_TYPE, pending_id: str):
+    if query.message.chat.id != ADMIN_GROUP_ID:
+        await query.answer()
         return
+    pending = store["pending"].get(pending_id)
+    if not pending:
+        # Handled elsewhere already; say so in a popup and drop the stale buttons
+        # instead of rewriting the whole message
+        await query.answer("⚠️ Confession already processed.")
+        await query.edit_message_reply_markup(reply_markup=None)
+        return
+    await query.answer()
+    conf_id = pending["id"]
+    await commit({"op": "approve", "pending_id": pending_id})
+    
+    # Use the alias in the post header
+    post_header = f"<b>{pending['user_alias']}'s Confession #{conf_id}</b>"
+    sent = await context.bot.send_message(CHANNEL_ID, f"{post_header}\n\n{pending['text']}", reply_markup=get_comment_link_markup(context.bot.username, conf_id))
+    
+    await commit({"op": "set_channel_message", "conf_id": conf_id, "message_id": sent.message_id})
+    await query.edit_message_text(f"✅ Approved and posted as #{conf_id}")
 
-    # Admin approve/reject
-    if query.message.chat.id != ADMIN_GROUP_ID: return
-    if data[0] == "approve":
-        pending = store["pending"].pop(data[1], None)
-        if pending:
-            conf_id = pending["id"]
-            store["posted"][str(conf_id)] = {"text": pending["text"], "user_alias": pending["user_alias"], "replies": [], "channel_message_id": None}
-            save_store()
-            
-            bot_username = (await context.bot.get_me()).username
-            keyboard = [[InlineKeyboardButton("💬 Add/View Comments", url=f"https://t.me/{bot_username}?start=comment_{conf_id}")]]
-            
-            # Use the alias in the post header
-            post_header = f"*{pending['user_alias']}'s Confession #{conf_id}*"
-            sent = await context.bot.send_message(CHANNEL_ID, f"{post_header}\n\n{pending['text']}", parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(keyboard))
-            
-            store["posted"][str(conf_id)]["channel_message_id"] = sent.message_id
-            save_store()
-            await query.edit_message_text(f"✅ Approved and posted as #{conf_id}")
-        else:
-            await query.edit_message_text("⚠️ Confession already processed.")
-
-    if data[0] == "reject":
-        if store["pending"].pop(data[1], None):
-            save_store()
-            await query.edit_message_text("❌ Rejected and removed.")
-        else:
-            await query.edit_message_text("⚠️ Confession already processed.")
+async def _cb_reject(query, context: ContextTypes.DEFAULT_TYPE, pending_id: str):
+    if query.message.chat.id != ADMIN_GROUP_ID:
+        await query.answer()
+        return
+    if pending_id not in store["pending"]:
+        await query.answer("⚠️ Confession already processed.")
+        await query.edit_message_reply_markup(reply_markup=None)
+        return
+    await query.answer()
+    await commit({"op": "reject", "pending_id": pending_id})
+    await query.edit_message_text("❌ Rejected and removed.")
+
+_CALLBACK_HANDLERS = {
+    "add_comment": _cb_add_comment,
+    "browse_comments": _cb_browse_comments,
+    "approve": _cb_approve,
+    "reject": _cb_reject,
+}
+# PTB only calls handle_callbacks for data of these shapes, so handlers can int() their argument directly.
+# Each handler answers its own query, so a stale click can get an explanatory popup.
+CALLBACK_PATTERN = re.compile(r"^(?:add_comment|browse_comments)\|\d+$|^(?:approve|reject)\|p\d+$")
+
+@serialized_per_chat
+async def handle_callbacks(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    action, _, arg = query.data.partition("|")
+    await _CALLBACK_HANDLERS[action](query, context, arg)
 
 
 # ===== Admin Commands Example =====
+@serialized_per_chat
 @is_admin_chat
 async def pending_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not store["pending"]:
         await update.message.reply_text("✅ No pending confessions.")
         return
-    msg = "*Pending Confessions List*\n\n"
-    for p in store["pending"].values():
-        msg += f"ID: {p['id']} (Alias: {p['user_alias']}) - {p['text'][:50]}...\n"
-    
-    # Add buttons to quickly approve the first few
+    # List the oldest few (dicts keep insertion order) with a quick-approve button each
+    total = len(store["pending"])
+    msg_parts = [f"<b>Pending Confessions List</b> ({total} total)\n\n"]
     keyboard = []
-    pending_ids = list(store["pending"].keys())[:MAX_BATCH_APPROVAL]
-    for pending_id in pending_ids:
-        conf_id = store["pending"][pending_id]["id"]
-        keyboard.append([InlineKeyboardButton(f"✅ #{conf_id}", callback_data=f"approve|{pending_id}")])
+    for pending_id, p in islice(store["pending"].items(), MAX_BATCH_APPROVAL):
+        msg_parts.append(f"ID: {p['id']} (Alias: {p['user_alias']}) - {excerpt(p['text'])}...\n")
+        keyboard.append([InlineKeyboardButton(f"✅ #{p['id']}", callback_data=f"approve|{pending_id}")])
+    if total > MAX_BATCH_APPROVAL:
+        msg_parts.append(f"\n…and {total - MAX_BATCH_APPROVAL} more.")
 
-    await update.message.reply_text(msg, parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(keyboard) if keyboard else None)
+    await update.message.reply_text("".join(msg_parts), reply_markup=InlineKeyboardMarkup(keyboard))
 
 
 # ===== Command Setup (Moved out of main for post_init) =====
@@ -272,14 +671,58 @@ async def set_bot_commands(application: Application):
         BotCommand("setalias", "Set or change your alias/nickname"),
         BotCommand("pending", "Admin: List pending confessions (in admin group)")
     ]
+    # Commands only change with a deploy, so skip the API call when this bot was last sent the same list
+    payload = orjson.dumps([application.bot.id, [c.to_dict() for c in commands]])
+    digest = hashlib.blake2b(payload, digest_size=8).hexdigest()
+    try:
+        with open(COMMANDS_HASH_FILE) as f:
+            if f.read() == digest:
+                logger.info("Bot commands unchanged.")
+                return
+    except OSError:
+        pass
     await application.bot.set_my_commands(commands)
     logger.info("Bot commands set.")
+    # Only a cache: failing to record it just means the commands are sent again next start.
+    # Written via a temp file so a half-written digest is never read back.
+    tmp_file = COMMANDS_HASH_FILE + ".tmp"
+    try:
+        with open(tmp_file, "w") as f:
+            f.write(digest)
+        os.replace(tmp_file, COMMANDS_HASH_FILE)
+    except OSError as e:
+        logger.warning(f"Failed to record bot commands hash in {COMMANDS_HASH_FILE}: {e}")
+
+async def post_init(application: Application):
+    start_commit_loop()
+    await set_bot_commands(application)
+
+async def post_shutdown(application: Application):
+    await stop_commit_loop()
 
 def main():
     load_store() # Load data store first
+
+    # uvloop is a faster drop-in event loop; PTB's run_* picks it up through the policy
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
     
     # post_init runs after bot is initialized but before polling/webhook starts
-    app = Application.builder().token(BOT_TOKEN).post_init(set_bot_commands).build()
+    app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .defaults(Defaults(parse_mode=ParseMode.HTML))
+        .concurrent_updates(True)
+        # Paces outgoing calls to Telegram's default flood limits; a 429 is waited out and
+        # retried up to 3 times (PTB's default is 0, which re-raises RetryAfter at once)
+        .rate_limiter(AIORateLimiter(max_retries=3))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # Handlers
     app.add_handler(CommandHandler("start", start_command))
@@ -288,16 +731,15 @@ def main():
     app.add_handler(CommandHandler("pending", pending_command))
     # This handler catches all non-command text, including new confessions AND comments
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE, handle_text_messages))
-    app.add_handler(CallbackQueryHandler(handle_callbacks))
+    app.add_handler(CallbackQueryHandler(handle_callbacks, pattern=CALLBACK_PATTERN))
 
-    # Deployment logic (prefers webhook but defaults to polling)
+    # Deployment logic (prefers webhook, falls back to polling)
     if WEBHOOK_URL:
-        # Webhook setup is usually for platforms like Heroku/FastAPI environments
         path = "/webhook/" + BOT_TOKEN
+        logger.info(f"Starting webhook at {WEBHOOK_URL}/webhook/...")
         app.run_webhook(listen="0.0.0.0", port=PORT, urlpath=path, webhook_url=WEBHOOK_URL + path)
-        logger.info(f"Webhook running at {WEBHOOK_URL + path}")
     else:
-        # Polling setup for platforms like Railway/Fly.io/local
+        # Polling setup for local runs or hosts without a public URL
         logger.warning("Webhook URL not set. Running in polling mode.")
         app.run_polling()
         